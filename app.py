@@ -1,17 +1,44 @@
-import os, io, json, re
-from typing import Dict, List
+import os, re, asyncio, hashlib
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from functools import lru_cache
+from typing import BinaryIO, Dict, List, Tuple, Union
+import httpx
 from dotenv import load_dotenv
-from fastapi import FastAPI, UploadFile, Form, File, Body
+from fastapi import FastAPI, UploadFile, Form, File, Body, HTTPException, Request
+from fastapi.concurrency import run_in_threadpool
+from starlette.background import BackgroundTask
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import HTMLResponse
+from fastapi.responses import HTMLResponse, ORJSONResponse, Response, StreamingResponse
 from pydantic import BaseModel, Field
-from pypdf import PdfReader
-from openai import OpenAI
+import pypdfium2 as pdfium
+import orjson
+import fastjsonschema
+from openai import (APIConnectionError, APIError, APITimeoutError, AsyncOpenAI, ConflictError,
+                    InternalServerError, RateLimitError)
+from aiolimiter import AsyncLimiter
+
+# ---------- env ----------
+load_dotenv()
+OPENAI_API_KEY = os.getenv("OPENAI_API_KEY", "")
+MODEL_NAME = os.getenv("MODEL_NAME", "gpt-4o-mini")
+ALLOWED_ORIGINS = os.getenv("ALLOWED_ORIGINS", "*")
+LLM_CONCURRENCY = int(os.getenv("LLM_CONCURRENCY", "32"))
+LLM_RPM = int(os.getenv("LLM_RPM", "500"))
+BATCH_K = int(os.getenv("BATCH_K", "5"))  # essays packed into one /score-batch request
+MAX_BATCH_ITEMS = int(os.getenv("MAX_BATCH_ITEMS", "50"))  # cap on essays per /score-batch call
+MAX_SCORE_CHARS = 5000  # essay chars sent to the model
+MAX_TEXT_BYTES = int(os.getenv("MAX_TEXT_BYTES", str(2 * 1024 * 1024)))  # cap for .txt uploads to /score
+if not OPENAI_API_KEY:
+    raise RuntimeError("Missing OPENAI_API_KEY. Set it in .env")
 
 class TextPayload(BaseModel):
     title: str = Field(default="untitled")
     text: str = Field(min_length=1, description="Essay text to score")
 
+class BatchPayload(BaseModel):
+    items: List[TextPayload] = Field(min_length=1, max_length=MAX_BATCH_ITEMS, description="Essays to score in one call")
+
 class Category(BaseModel):
     name: str = Field(min_length=2, max_length=40, description="JSON key to return (e.g., 'argumentation' or 'intellectual_curiosity')")
     description: str = Field(default="", max_length=200, description="What this category means")
@@ -22,19 +49,60 @@ class FlexPayload(BaseModel):
     categories: List[Category] = Field(min_items=1)
     quotes: bool = False  # set true if you want a short evidence quote per category
 
-# ---------- env ----------
-load_dotenv()
-OPENAI_API_KEY = os.getenv("OPENAI_API_KEY", "")
-MODEL_NAME = os.getenv("MODEL_NAME", "gpt-4o-mini")
-ALLOWED_ORIGINS = os.getenv("ALLOWED_ORIGINS", "*")
-if not OPENAI_API_KEY:
-    raise RuntimeError("Missing OPENAI_API_KEY. Set it in .env")
-
 # ---------- llm client ----------
-client = OpenAI(api_key=OPENAI_API_KEY)
+# One shared HTTP/2 pool per worker so concurrent calls reuse connections instead of new TLS handshakes
+_http = httpx.AsyncClient(
+    http2=True,
+    limits=httpx.Limits(max_connections=200, max_keepalive_connections=100),
+    timeout=httpx.Timeout(60.0, connect=5.0),
+)
+# max_retries=0: chat_completion owns retries so every attempt goes through the limiter
+aclient = AsyncOpenAI(api_key=OPENAI_API_KEY, http_client=_http, max_retries=0)
+SEM = asyncio.Semaphore(LLM_CONCURRENCY)   # max in-flight LLM calls per worker
+LIMITER = AsyncLimiter(LLM_RPM, 60)        # pace requests to the account's RPM
+RETRY_DELAYS = (0.5, 1, 2)                 # backoff between retries of transient failures
+# What the SDK would retry by default (timeouts are a subclass of connection errors)
+RETRYABLE = (RateLimitError, APIConnectionError, APITimeoutError, ConflictError, InternalServerError)
+
+def _is_retryable(e: Exception) -> bool:
+    return isinstance(e, RETRYABLE) or getattr(e, "status_code", None) == 408
+
+async def _with_retries(call):
+    # Every LLM call goes through here so the rate limit + retry policy apply everywhere
+    for delay in RETRY_DELAYS + (None,):
+        await LIMITER.acquire()
+        try:
+            return await call()
+        except APIError as e:
+            if delay is None or not _is_retryable(e):
+                raise
+            await asyncio.sleep(delay)
+
+async def chat_completion(**kwargs):
+    async def call():
+        async with SEM:
+            return await aclient.chat.completions.create(**kwargs)
+    return await _with_retries(call)
+
+async def open_chat_stream(**kwargs):
+    # Like chat_completion(stream=True), but the SEM permit stays held while the stream is read;
+    # the caller must SEM.release() once it is done with the stream
+    async def call():
+        await SEM.acquire()
+        try:
+            return await aclient.chat.completions.create(stream=True, **kwargs)
+        except BaseException:
+            SEM.release()
+            raise
+    return await _with_retries(call)
 
 # ---------- fastapi ----------
-app = FastAPI(title="AI Portfolio MVP", version="0.1.0")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    yield
+    await _http.aclose()
+
+app = FastAPI(title="AI Portfolio MVP", version="0.1.0", default_response_class=ORJSONResponse, lifespan=lifespan)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=[ALLOWED_ORIGINS] if ALLOWED_ORIGINS != "*" else ["*"],
@@ -56,11 +124,53 @@ creativity: 0=generic, 1=some originality, 2=unique voice, 3=novel insight
 """
 
 # ---------- utilities ----------
-def extract_text_from_pdf(file_bytes: bytes, max_pages: int = 5) -> str:
-    reader = PdfReader(io.BytesIO(file_bytes))
+# Small bounded LRUs on OrderedDict; values are never None, so None means a miss
+def _lru_get(cache: OrderedDict, key):
+    if key in cache:
+        cache.move_to_end(key)
+        return cache[key]
+    return None
+
+def _lru_put(cache: OrderedDict, key, value, maxsize: int) -> None:
+    cache[key] = value
+    if len(cache) > maxsize:
+        cache.popitem(last=False)
+
+# (content hash, max_pages) -> extracted text, so re-uploading the same PDF skips parsing
+PDF_TEXT_CACHE: "OrderedDict[Tuple[bytes, int], str]" = OrderedDict()
+PDF_TEXT_CACHE_SIZE = 256
+
+def _pdf_digest(file_bytes: Union[bytes, BinaryIO]) -> bytes:
+    h = hashlib.blake2b(digest_size=16)
+    if isinstance(file_bytes, (bytes, bytearray)):
+        h.update(file_bytes)
+    else:
+        for chunk in iter(lambda: file_bytes.read(64 * 1024), b""):
+            h.update(chunk)
+        file_bytes.seek(0)
+    return h.digest()
+
+def extract_text_from_pdf(file_bytes: Union[bytes, BinaryIO], max_pages: int = 5) -> str:
+    key = (_pdf_digest(file_bytes), max_pages)
+    text = _lru_get(PDF_TEXT_CACHE, key)
+    if text is None:
+        text = _extract_text_from_pdf(file_bytes, max_pages)
+        _lru_put(PDF_TEXT_CACHE, key, text, PDF_TEXT_CACHE_SIZE)
+    return text
+
+def _extract_text_from_pdf(file_bytes: Union[bytes, BinaryIO], max_pages: int) -> str:
+    # pdfium reads seekable file objects directly, so uploads don't have to be loaded into memory
+    doc = pdfium.PdfDocument(file_bytes)
     pages = []
-    for p in reader.pages[:max_pages]:
-        pages.append(p.extract_text() or "")
+    try:
+        for i in range(min(len(doc), max_pages)):
+            page = doc[i]
+            textpage = page.get_textpage()
+            pages.append(textpage.get_text_bounded())
+            textpage.close()
+            page.close()
+    finally:
+        doc.close()
     return "\n".join(pages)
 
 def extract_text_generic(file: UploadFile) -> str:
@@ -71,43 +181,163 @@ def extract_text_generic(file: UploadFile) -> str:
     # naive text read for .txt; DOCX/others: add parsers later
     return file.file.read().decode("utf-8", "ignore")
 
+# one pass for both; the name pattern is a very crude “Firstname Lastname”, replace or enhance later
+_PII_RE = re.compile(
+    r"(?P<email>[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Za-z]{2,})"
+    r"|(?P<name>\b[A-Z][a-z]+ [A-Z][a-z]+\b)"
+)
+
+def _pii_token(m: re.Match) -> str:
+    return "〈REDACTED_EMAIL〉" if m.lastgroup == "email" else "〈REDACTED_NAME〉"
+
 def redact_basic_pii(text: str) -> str:
-    text = re.sub(r"[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Za-z]{2,}", "〈REDACTED_EMAIL〉", text)
-    # very crude “Firstname Lastname” pattern; replace or enhance later
-    text = re.sub(r"\b[A-Z][a-z]+ [A-Z][a-z]+\b", "〈REDACTED_NAME〉", text)
-    return text
+    return _PII_RE.sub(_pii_token, text)
+
+PII_WINDOW_PAD = 256  # redact a bit past the cut so PII straddling MAX_SCORE_CHARS still matches
+
+def prepare_essay(text: str) -> str:
+    # Redact only the window the model will see (plus padding), then cut to MAX_SCORE_CHARS
+    window = text[:MAX_SCORE_CHARS + PII_WINDOW_PAD]
+    if len(text) > len(window):
+        # drop the word split by the padded cut so a partial email/name can't slip through
+        parts = window.rsplit(None, 1)
+        window = parts[0] if len(parts) > 1 else ""
+    return redact_basic_pii(window)[:MAX_SCORE_CHARS]
+
+# stripped essay text -> validated scores, shared by single and packed scoring
+SCORE_CACHE: "OrderedDict[str, Dict]" = OrderedDict()
+SCORE_CACHE_SIZE = 2048
+
+async def score_text_llm(text: str) -> Dict:
+    # Callers truncate to MAX_SCORE_CHARS before redacting, so the key stays small
+    text = text.strip()
+    data = _lru_get(SCORE_CACHE, text)
+    if data is None:
+        data = await _score_text_llm_uncached(text)
+        _lru_put(SCORE_CACHE, text, data, SCORE_CACHE_SIZE)
+    return data
 
-def score_text_llm(text: str) -> Dict:
+async def _score_text_llm_uncached(text: str) -> Dict:
     system_msg = "You are an assistant that scores student work. Output JSON only."
     user_msg = f"""Text:
-\"\"\"{text[:5000]}\"\"\"
+\"\"\"{text}\"\"\"
 
 {RUBRIC}
 Task:
 Return JSON: {{"argumentation":0-3, "writing":0-3, "creativity":0-3}}. No extra text."""
-    resp = client.chat.completions.create(
+    # JSON mode guarantees parseable output, so no repair round-trip is needed
+    resp = await chat_completion(
         model=MODEL_NAME,
         temperature=0,
+        response_format={"type": "json_object"},
         messages=[{"role":"system","content":system_msg},{"role":"user","content":user_msg}]
     )
-    raw = resp.choices[0].message.content.strip()
+    data = orjson.loads(resp.choices[0].message.content)
+
+    # Validate with Pydantic (enforces 3 ints) and drop any extra keys
+    return Scores(**data).model_dump()
+
+async def score_texts_llm(texts: List[str]) -> List:
+    # Packs the uncached essays into one request so they share the rubric tokens and use one RPM slot
+    texts = [t.strip() for t in texts]
+    results = [_lru_get(SCORE_CACHE, t) for t in texts]
+    todo = [i for i, r in enumerate(results) if r is None]
+    if len(todo) <= 1:
+        fresh = await asyncio.gather(*[score_text_llm(texts[i]) for i in todo], return_exceptions=True)
+    else:
+        fresh = await _score_packed([texts[i] for i in todo])
+    # Errors stay per item so cached hits in the same chunk are still returned
+    for i, r in zip(todo, fresh):
+        results[i] = r
+    return results
+
+async def _score_packed(texts: List[str]) -> List:
+    system_msg = "You are an assistant that scores student work. Output JSON only."
+    items = orjson.dumps([{"id": i, "text": t} for i, t in enumerate(texts)]).decode()
+    user_msg = f"""Texts (JSON list):
+{items}
 
-    # Try parse → quick repair if needed
+{RUBRIC}
+Task:
+Score each text independently. Return JSON with one object per text:
+{{"results": [{{"id":<id>, "argumentation":0-3, "writing":0-3, "creativity":0-3}}, ...]}}. No extra text."""
     try:
-        data = json.loads(raw)
-    except Exception:
-        fixer = client.chat.completions.create(
+        resp = await chat_completion(
             model=MODEL_NAME,
             temperature=0,
-            messages=[
-                {"role":"system","content":"Fix invalid JSON to match: keys argumentation, writing, creativity as integers 0..3. Output JSON only."},
-                {"role":"user","content":raw}
-            ]
+            response_format={"type": "json_object"},
+            messages=[{"role":"system","content":system_msg},{"role":"user","content":user_msg}]
         )
-        data = json.loads(fixer.choices[0].message.content)
+        by_id = {r["id"]: r for r in orjson.loads(resp.choices[0].message.content)["results"]}
+        fresh = [Scores(**by_id[i]).model_dump() for i in range(len(texts))]
+    except Exception:
+        # Failed call or bad/incomplete array → score each essay on its own
+        return await asyncio.gather(*[score_text_llm(t) for t in texts], return_exceptions=True)
+    for t, data in zip(texts, fresh):
+        _lru_put(SCORE_CACHE, t, data, SCORE_CACHE_SIZE)
+    return fresh
+
+# (text, cat_key, quotes) -> validated scores; plain LRU since results are stored after a stream finishes
+FLEX_CACHE: "OrderedDict[tuple, Dict]" = OrderedDict()
+FLEX_CACHE_SIZE = 2048
+
+@lru_cache(maxsize=256)
+def _build_prompt_parts(cat_key: Tuple[Tuple[str, str], ...], quotes: bool) -> Tuple[str, str]:
+    # Depends only on the categories + quotes flag, not the essay, so it's memoized
+    cat_lines = "\n".join([f"- {name}: {description or 'Assess per the scale; stay on-topic.'}"
+                           for name, description in cat_key])
+    quote_shape = ', "quote":"≤25 words"' if quotes else ""
+    json_shape = "{ " + ", ".join(
+        [f'"{name}": {{"score":0-3{quote_shape}}}' for name, _ in cat_key]
+    ) + " }"
+    return cat_lines, json_shape
+
+def flex_messages(text: str, cat_key: Tuple[Tuple[str, str], ...], quotes: bool) -> List[Dict]:
+    # Build a dynamic rubric from cat_key = ((name, description), ...)
+    base_scale = "Use 0–3 where 0=insufficient, 1=emerging, 2=proficient, 3=advanced."
+    cat_lines, json_shape = _build_prompt_parts(cat_key, quotes)
 
-    # Validate with Pydantic (enforces 3 ints)
-    Scores(**data)
+    sys = "You are an assistant that scores student work. Always output JSON only."
+
+    user = f"""Text:
+\"\"\"{text}\"\"\"
+
+RUBRIC:
+{base_scale}
+Score these categories:
+{cat_lines}
+
+Task:
+Return JSON exactly with these keys and this shape:
+{json_shape}
+No extra fields or prose."""
+    return [{"role":"system","content":sys},{"role":"user","content":user}]
+
+# A quote is at most 25 whitespace-separated words
+QUOTE_PATTERN = r"^\s*(?:\S+\s+){0,24}\S*\s*$"
+
+def _category_validator(quotes: bool):
+    # One category's shape: a 0..3 score (and a quote if requested). Category names are user input,
+    # so they never go into the generated validator code; validate_flex loops over them instead.
+    props = {"score": {"type": "integer", "enum": [0, 1, 2, 3]}}
+    if quotes:
+        props["quote"] = {"type": "string", "pattern": QUOTE_PATTERN}
+    return fastjsonschema.compile({"type": "object", "properties": props, "required": list(props)})
+
+CATEGORY_VALIDATORS = {quotes: _category_validator(quotes) for quotes in (False, True)}
+
+def validate_flex(data: Dict, cat_key: Tuple[Tuple[str, str], ...], quotes: bool) -> Dict:
+    # Every category must be present and match the compiled per-category schema
+    if not isinstance(data, dict):
+        raise ValueError("Response is not a JSON object.")
+    check = CATEGORY_VALIDATORS[quotes]
+    for name, _ in cat_key:
+        if name not in data:
+            raise ValueError(f"Missing category '{name}' in response.")
+        try:
+            check(data[name])
+        except fastjsonschema.JsonSchemaValueException as e:
+            raise ValueError(f"Invalid result for '{name}': {e.message}")
     return data
 
 # ---------- routes ----------
@@ -117,16 +347,21 @@ def health():
 
 @app.post("/score")
 async def score(file: UploadFile = File(...), title: str = Form("untitled")):
-    raw = await file.read()
-
     if file.filename.lower().endswith(".pdf"):
-        text = extract_text_from_pdf(raw, max_pages=5)
+        # hand the spooled upload straight to pdfium instead of copying it into bytes;
+        # hashing + parsing do blocking (possibly disk) I/O, so keep them off the event loop
+        await file.seek(0)
+        text = await run_in_threadpool(extract_text_from_pdf, file.file, max_pages=5)
     else:
         # fallback for .txt; add DOCX parser later
-        text = raw.decode("utf-8", "ignore")
+        buf = bytearray()
+        while chunk := await file.read(64 * 1024):
+            buf.extend(chunk)
+            if len(buf) > MAX_TEXT_BYTES:
+                raise HTTPException(status_code=413, detail=f"Text upload exceeds {MAX_TEXT_BYTES} bytes.")
+        text = buf.decode("utf-8", "ignore")
 
-    text = redact_basic_pii(text)
-    scores = score_text_llm(text)
+    scores = await score_text_llm(prepare_essay(text))
 
     return {
         "title": title,
@@ -137,19 +372,40 @@ async def score(file: UploadFile = File(...), title: str = Form("untitled")):
     }
 
 @app.post("/score-text")
-def score_text(payload: TextPayload = Body(...)):
-    text = redact_basic_pii(payload.text)
-    scores = score_text_llm(text)
+async def score_text(payload: TextPayload = Body(...)):
+    scores = await score_text_llm(prepare_essay(payload.text))
     return {
         "title": payload.title,
         "scores": scores,
-        "tokens_estimate": len(text.split()),
+        "tokens_estimate": len(payload.text.split()),
         "model_version": MODEL_NAME
     }
 
-@app.get("/", response_class=HTMLResponse)
-def index():
-    return """
+@app.post("/score-batch")
+async def score_batch(payload: BatchPayload = Body(...)):
+    # BATCH_K essays per request, requests fanned out concurrently;
+    # chat_completion's semaphore + limiter keep this bounded
+    texts = [prepare_essay(i.text) for i in payload.items]
+    chunks = [texts[i:i + BATCH_K] for i in range(0, len(texts), BATCH_K)]
+    chunk_results = await asyncio.gather(*[score_texts_llm(c) for c in chunks], return_exceptions=True)
+    results = []
+    for chunk, res in zip(chunks, chunk_results):
+        results.extend([res] * len(chunk) if isinstance(res, Exception) else res)
+
+    out = []
+    for item, res in zip(payload.items, results):
+        if isinstance(res, Exception):
+            out.append({"title": item.title, "error": str(res)})
+            continue
+        out.append({
+            "title": item.title,
+            "scores": res,
+            "tokens_estimate": len(item.text.split()),
+        })
+    return {"results": out, "model_version": MODEL_NAME}
+
+# Landing page is static: encode once, let browsers cache it and revalidate via ETag
+INDEX_HTML = """
 <!DOCTYPE html>
 <html lang="en">
 <head>
@@ -188,7 +444,7 @@ creativity: Originality, novel insight, unique voice</textarea>
 <div class="row">
   <button id="sample">Insert sample</button>
   <button id="scoreBtn">Score with current categories</button>
-  <span class="small">Sends JSON to <code>/score-text-flex</code> and shows the result.</span>
+  <span class="small">Sends JSON to <code>/score-text-flex</code> and streams the result.</span>
 </div>
 
 <h2>Result</h2>
@@ -233,8 +489,25 @@ $("scoreBtn").onclick = async () => {
       headers: {"Content-Type": "application/json"},
       body: JSON.stringify({ title, text, categories: cats, quotes })
     });
-    const json = await res.json();
-    $("out").textContent = JSON.stringify(json, null, 2);
+    if (!res.ok) { $("out").textContent = "Error: " + res.status + " " + await res.text(); return; }
+    // NDJSON stream: {"delta": ...} chunks of raw model output, then the final result
+    const reader = res.body.getReader();
+    const decoder = new TextDecoder();
+    let buf = "", partial = "";
+    for (;;) {
+      const { value, done } = await reader.read();
+      if (done) break;
+      buf += decoder.decode(value, { stream: true });
+      let nl;
+      while ((nl = buf.indexOf("\\n")) >= 0) {
+        const line = buf.slice(0, nl);
+        buf = buf.slice(nl + 1);
+        if (!line) continue;
+        const msg = JSON.parse(line);
+        if ("delta" in msg) { partial += msg.delta; $("out").textContent = partial; }
+        else $("out").textContent = JSON.stringify(msg, null, 2);
+      }
+    }
   } catch (err) {
     $("out").textContent = "Error: " + (err?.message || err);
   }
@@ -243,68 +516,78 @@ $("scoreBtn").onclick = async () => {
 </body>
 </html>
 """
+INDEX_BYTES = INDEX_HTML.encode("utf-8")
+INDEX_HEADERS = {
+    "Cache-Control": "public, max-age=3600",
+    "ETag": f'"{hashlib.blake2b(INDEX_BYTES, digest_size=16).hexdigest()}"',
+}
 
-@app.post("/score-text-flex")
-def score_text_flex(payload: FlexPayload = Body(...)):
-    # Build a dynamic rubric from the categories the browser sends
-    base_scale = "Use 0–3 where 0=insufficient, 1=emerging, 2=proficient, 3=advanced."
-    cat_lines = "\n".join([f"- {c.name}: {c.description or 'Assess per the scale; stay on-topic.'}"
-                           for c in payload.categories])
-
-    sys = "You are an assistant that scores student work. Always output JSON only."
-    wants_quotes = payload.quotes
-    json_shape = "{ " + ", ".join(
-        [f"\"{c.name}\": {{\"score\":0-3{', \"quote\":\"≤25 words\"' if wants_quotes else ''}}}" for c in payload.categories]
-    ) + " }"
-
-    user = f"""Text:
-\"\"\"{redact_basic_pii(payload.text)[:6000]}\"\"\"
-
-RUBRIC:
-{base_scale}
-Score these categories:
-{cat_lines}
-
-Task:
-Return JSON exactly with these keys and this shape:
-{json_shape}
-No extra fields or prose."""
+@app.get("/", response_class=HTMLResponse)
+def index(request: Request):
+    if request.headers.get("if-none-match") == INDEX_HEADERS["ETag"]:
+        return Response(status_code=304, headers=INDEX_HEADERS)
+    return Response(content=INDEX_BYTES, media_type="text/html", headers=INDEX_HEADERS)
 
-    resp = client.chat.completions.create(
+@app.post("/score-text-flex")
+async def score_text_flex(payload: FlexPayload = Body(...)):
+    # Streams NDJSON: {"delta": ...} lines with raw model output as it arrives,
+    # then one final line with the validated result (or {"error": ...})
+    text = prepare_essay(payload.text).strip()
+    cat_key = tuple((c.name, c.description) for c in payload.categories)
+    key = (text, cat_key, payload.quotes)
+
+    def final(data: Dict) -> bytes:
+        return orjson.dumps({
+            "title": payload.title,
+            "scores": data,
+            "tokens_estimate": len(payload.text.split()),
+            "model_version": MODEL_NAME
+        }) + b"\n"
+
+    cached = _lru_get(FLEX_CACHE, key)
+    if cached is not None:
+        return StreamingResponse(iter([final(cached)]), media_type="application/x-ndjson")
+
+    # Open the stream before responding so API errors still surface as a normal error status
+    stream = await open_chat_stream(
         model=MODEL_NAME, temperature=0,
-        messages=[{"role":"system","content":sys},{"role":"user","content":user}]
+        response_format={"type": "json_object"},
+        messages=flex_messages(*key)
     )
-    raw = resp.choices[0].message.content.strip()
-
-    # Basic repair if the model adds stray text
-    import json
-    try:
-        data = json.loads(raw)
-    except Exception:
-        fixer = client.chat.completions.create(
-            model=MODEL_NAME, temperature=0,
-            messages=[
-                {"role":"system","content":"Fix to valid JSON only. Keep the same keys and structure."},
-                {"role":"user","content":raw}
-            ]
-        )
-        data = json.loads(fixer.choices[0].message.content)
-
-    # Minimal validation: ensure all categories exist with score 0..3 (and quote if requested)
-    for c in payload.categories:
-        if c.name not in data or not isinstance(data[c.name], dict):
-            raise ValueError(f"Missing category '{c.name}' in response.")
-        s = data[c.name].get("score", None)
-        if not isinstance(s, int) or s not in (0,1,2,3):
-            raise ValueError(f"Invalid score for '{c.name}': {s}")
-        if wants_quotes:
-            q = data[c.name].get("quote", "")
-            if not isinstance(q, str) or len(q.split()) > 25:
-                raise ValueError(f"Quote too long or missing for '{c.name}'.")
-
-    return {
-        "title": payload.title,
-        "scores": data,
-        "tokens_estimate": len(payload.text.split()),
-        "model_version": MODEL_NAME
-    }
\ No newline at end of file
+    released = False
+
+    async def release():
+        # Runs from gen()'s finally and as a background task, so an unread response is cleaned up too
+        nonlocal released
+        if released:
+            return
+        released = True
+        try:
+            await stream.close()
+        finally:
+            SEM.release()
+
+    async def gen():
+        parts = []
+        try:
+            async for chunk in stream:
+                delta = chunk.choices[0].delta.content if chunk.choices else None
+                if delta:
+                    parts.append(delta)
+                    yield orjson.dumps({"delta": delta}) + b"\n"
+        except (APIError, httpx.HTTPError) as e:
+            # headers are already sent, so report mid-stream failures in-band
+            yield orjson.dumps({"error": f"LLM stream failed: {e}"}) + b"\n"
+            return
+        finally:
+            # free the pooled connection and the concurrency permit as soon as reading stops
+            await release()
+        try:
+            data = validate_flex(orjson.loads("".join(parts)), cat_key, payload.quotes)
+        except ValueError as e:
+            yield orjson.dumps({"error": str(e)}) + b"\n"
+            return
+        _lru_put(FLEX_CACHE, key, data, FLEX_CACHE_SIZE)
+        yield final(data)
+
+    return StreamingResponse(gen(), media_type="application/x-ndjson", background=BackgroundTask(release))
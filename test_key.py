@@ -1,16 +1,23 @@
 # Simple script to test that my OpenAI key is properly functioning.
 
 import os
+from functools import lru_cache
 from openai import OpenAI
 from dotenv import load_dotenv
 
-# Load environment variables from .env
-load_dotenv()
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+@lru_cache(maxsize=1)
+def get_client() -> OpenAI:
+    # Built on first use only, so importing this module never opens a connection
+    return OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
 
-resp = client.chat.completions.create(
-    model="gpt-4o-mini",
-    messages=[{"role": "user", "content": "Say hello in one sentence"}],
-)
+if __name__ == "__main__":
+    # Load environment variables from .env
+    load_dotenv()
+    client = get_client()
 
-print(resp.choices[0].message.content)
\ No newline at end of file
+    resp = client.chat.completions.create(
+        model="gpt-4o-mini",
+        messages=[{"role": "user", "content": "Say hello in one sentence"}],
+    )
+
+    print(resp.choices[0].message.content)